@@ -27,7 +27,7 @@ if __name__ == '__main__':
   
     metadata_df = pd.read_csv(output_path, index_col=0) if os.path.exists(output_path) else pd.read_hdf(args.input_path, key='metadata')
 
-    model = Classifier.load(os.path.join(args.models_dir, args.model_name + '.pkl'))
+    model = Classifier.load(os.path.join(args.models_dir, args.model_name))
     
     kwargs = {'add_length_feature':args.add_length_feature, 'aa_tokens_only':args.aa_tokens_only}
     dataset = Dataset.from_hdf(args.input_path, feature_type=args.feature_type, n_classes=args.n_classes, **kwargs)
@@ -29,7 +29,7 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    model_name = f'model_{args.output_dim}c_{args.feature_type}.pkl' if (args.model_name is None) else f'{args.model_name}.pkl'
+    model_name = f'model_{args.output_dim}c_{args.feature_type}' if (args.model_name is None) else args.model_name
     
     train_dataset = Dataset.from_hdf(args.train_data_path, n_classes=args.output_dim, feature_type=args.feature_type, add_length_feature=args.add_length_feature, aa_tokens_only=args.aa_tokens_only)
     val_dataset = Dataset.from_hdf(args.val_data_path, n_classes=args.output_dim, feature_type=args.feature_type, add_length_feature=args.add_length_feature, aa_tokens_only=args.aa_tokens_only)
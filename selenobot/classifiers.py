@@ -1,7 +1,7 @@
 '''A binary classification head and associated utilities, designed for handling embedding objects.'''
 
 from tqdm import tqdm
-from typing import Optional, NoReturn, Tuple, List
+from typing import Optional, NoReturn, Tuple, List, Dict
 from selenobot.datasets import get_dataloader
 import sys
 import torch
@@ -10,12 +10,16 @@ import numpy as np
 import pandas as pd
 import torch.nn.functional
 import sklearn
-# import json
+import json
+import safetensors.torch
 import time
 from sklearn.metrics import balanced_accuracy_score
 from selenobot.utils import NumpyEncoder
 import warnings
 import copy
+import contextlib
+import shutil
+import subprocess
 import io
 import pickle
 import joblib
@@ -32,6 +36,10 @@ from Bio.SeqRecord import SeqRecord
 # warnings.simplefilter('ignore')
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
+# Dynamic shapes are enabled when compiling, but leave some headroom for recompilations (e.g. when switching
+# between training and inference batch sizes). 
+torch._dynamo.config.cache_size_limit = 64
+
 
 class Unpickler(pickle.Unpickler):
     '''https://github.com/pytorch/pytorch/issues/16797'''
@@ -51,7 +59,8 @@ class WeightedCrossEntropyLoss(torch.nn.Module):
 
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.dtype = torch.bfloat16 if half_precision else torch.float32
-        self.weights = torch.Tensor([1] * n_classes).to(self.dtype).to(self.device)
+        # Register the weights as a buffer so they are moved along with the module, rather than being copied to the device on each call. 
+        self.register_buffer('weights', torch.ones(n_classes, dtype=self.dtype), persistent=False)
         self.n_classes = n_classes
 
         self.to(self.device) # Not actually sure if this is necessary. 
@@ -60,10 +69,10 @@ class WeightedCrossEntropyLoss(torch.nn.Module):
         '''Compute the weights to use based on the inverse frequencies of each class. '''
 
         N = len(dataset)
-        n = [(dataset.labels == i).sum() for i in range(self.n_classes)]
+        n = torch.bincount(dataset.labels, minlength=self.n_classes)
         # NOTE: I wonder if I should be scaling this by the number of classes, so that more classes
         # doesn't result in larger weights? I am going to to keep things between 0 and 1. 
-        self.weights = torch.Tensor([(N / (n_i * self.n_classes)) for n_i in n]).to(self.dtype).to(self.device)
+        self.weights.copy_(N / (n * self.n_classes))
 
 
     # NOTE: Targets can be class indices, as opposed to class probabilities. Should decide which one to use. 
@@ -74,13 +83,10 @@ class WeightedCrossEntropyLoss(torch.nn.Module):
         :param targets: A Tensor of size (batch_size, n_classes). All values should be 0 or 1.  
         '''
         outputs = outputs.view(targets.shape) # Make sure the outputs and targets have the same shape. Use view to avoid copying. 
-        # Reduction specifies the reduction to apply to the output. If 'none', no reduction will be applied, if 'mean,' the weighted mean of the output is taken.
-        ce = torch.nn.functional.cross_entropy(outputs, targets, reduction='none')
-
-        w = torch.unsqueeze(self.weights, 0).repeat(len(outputs), 1)
-        w = (targets * w).sum(axis=1)
-
-        return (ce * w).mean()
+        # Because the targets are one-hot encoded, passing the class weights directly weights each instance's loss by the weight
+        # of its class, so the softmax, weighting, and reduction all happen in a single fused call. With class probability targets,
+        # the 'mean' reduction divides by the batch size (not the sum of the weights), matching the previous weighted mean. 
+        return torch.nn.functional.cross_entropy(outputs, targets, weight=self.weights, reduction='mean')
 
 
 class NN(torch.nn.Module):
@@ -108,30 +114,72 @@ class NN(torch.nn.Module):
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.to(self.device)
 
+        self.quantized = False
+        self.compile_model()
+
+    def compile_model(self):
+        '''Use torch.compile to fuse the Linear, ReLU, and Linear layers into as few kernels as possible, which avoids
+        round-tripping the intermediate activations through GPU memory. The model is compiled in-place, so the state dict
+        is unchanged. Compilation is skipped on CPU.'''
+        if self.device == 'cuda':
+            self.model.compile(mode='max-autotune', dynamic=True, fullgraph=True)
+
+    @contextlib.contextmanager
+    def evaluating(self):
+        '''Temporarily put the model in evaluation mode, which changes the forward behavior of the model (e.g. disables dropout). 
+        The previous mode is restored on exit, so calling predict during training does not leave the model in evaluation mode.'''
+        training = self.training
+        self.eval()
+        try:
+            yield
+        finally:
+            self.train(training)
+
+    def autocast(self):
+        '''Run the enclosed operations in bfloat16 mixed precision when on a GPU. No gradient scaling is necessary, as
+        bfloat16 has the same range as float32.'''
+        return torch.autocast(device_type=self.device, dtype=torch.bfloat16, enabled=(self.device == 'cuda'))
 
     # TODO: Do I still need the batch size parameter here?
     def forward(self, inputs:torch.FloatTensor):
         '''A forward pass of the Classifier.'''
-        self.to(device)
         return self.model(inputs) 
 
 
-    def predict(self, dataset) -> pd.DataFrame:
-        '''Evaluate the Classifier on the data in the input Dataset.'''   
-        self.eval() # Put the model in evaluation mode. This changes the forward behavior of the model (e.g. disables dropout).
-        dataset = dataset.scale(self.scaler)
-        with torch.no_grad(): # Turn off gradient computation, which reduces memory usage. 
-            outputs = self(dataset.embeddings) # Run a forward pass of the model. Batch to limit memory usage.
-            # Apply sigmoid activation, which is usually applied as a part of the loss function. 
-            outputs = torch.nn.functional.softmax(outputs, 1)
-            outputs = outputs.cpu().numpy()
+    def forward_fused(self, inputs:torch.FloatTensor) -> torch.FloatTensor:
+        '''A forward pass of the Classifier using a single Triton kernel, which also applies the softmax activation. The hidden
+        layer activations stay in registers, rather than being written to and read back from GPU memory. Only available on a GPU.'''
+        assert self.device == 'cuda', 'NN.forward_fused: The fused kernel can only be used on a GPU.'
+        from selenobot.kernels import mlp_softmax # Triton is only usable with a GPU, so import it here. 
+        linear_1, linear_2 = self.model[0], self.model[2]
+        return mlp_softmax(inputs, linear_1.weight, linear_1.bias, linear_2.weight, linear_2.bias)
 
-            # Organize the predictions into a DataFrame.
-            predictions = pd.DataFrame(index=dataset.ids)
-            for i in range(outputs.shape[-1]):
-                predictions[f'probability_{i}'] = outputs[:, i].ravel()
-            predictions['prediction'] = np.argmax(outputs, axis=1).ravel() # Convert out of one-hot encodings.
-            return predictions
+    def predict(self, dataset, fused:bool=False, chunk_size:int=8192) -> pd.DataFrame:
+        '''Evaluate the Classifier on the data in the input Dataset.
+        
+        :param dataset: The Dataset containing the data on which to run the model. 
+        :param fused: Whether or not to run the forward pass using the fused Triton kernel (see NN.forward_fused). 
+        :param chunk_size: The number of instances to run through the model at once. This bounds the memory used by the 
+            intermediate activations, regardless of the size of the Dataset. 
+        '''   
+        dataset = dataset.scale(self.scaler)
+        # Inference mode turns off gradient computation and version counter tracking, which reduces memory usage and overhead. 
+        with torch.inference_mode(), self.evaluating(), self.autocast(): 
+            outputs = []
+            for chunk in dataset.embeddings.split(chunk_size): # Run the forward pass in chunks to limit memory usage. 
+                if fused:
+                    outputs.append(self.forward_fused(chunk))
+                else: # Apply softmax activation, which is usually applied as a part of the loss function. 
+                    outputs.append(torch.nn.functional.softmax(self(chunk).float(), 1))
+            outputs = torch.cat(outputs, dim=0)
+            labels = torch.argmax(outputs, 1) # Convert out of one-hot encodings on the device. 
+        # Only copy to the CPU once all computation is done. 
+        outputs, labels = outputs.cpu().numpy(), labels.cpu().numpy()
+
+        # Organize the predictions into a DataFrame.
+        predictions = pd.DataFrame({f'probability_{i}':outputs[:, i] for i in range(outputs.shape[-1])}, index=dataset.ids)
+        predictions['prediction'] = labels
+        return predictions
 
 
     def accuracy(self, dataset) -> float:
@@ -141,7 +189,57 @@ class NN(torch.nn.Module):
         return balanced_accuracy_score(labels, predictions)
 
 
-    def fit(self, train_dataset, val_dataset, epochs:int=10, lr:float=1e-8, batch_size:int=16, balance_batches:bool=True, weighted_loss:bool=False):
+    def quantize(self):
+        '''Quantize the weights of the Linear layers for faster inference. The model is memory-bound at inference time, so 
+        reducing the size of the weights speeds up prediction. Dynamic int8 quantization is only supported on CPU, so the weights 
+        are cast to bfloat16 when running on a GPU. The model can't be trained after it has been quantized.'''
+        if self.device == 'cuda':
+            self.model = self.model.to(torch.bfloat16)
+        else:
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.compile_model() # Make sure the quantized model is compiled. 
+        self.quantized = True
+
+    def export(self, path:str, fp16:bool=True, opt_batch_size:int=1024, max_batch_size:int=65536):
+        '''Export the model to ONNX for ahead-of-time compiled inference. The fitted scaler is folded into the first Linear layer and
+        the softmax is appended, so the exported model takes unscaled embeddings and outputs class probabilities. If the TensorRT 
+        trtexec tool is available, it is also used to build an engine from the ONNX file.
+
+        :param path: The path (without extension) where the .onnx and .engine files will be written. 
+        :param fp16: Whether or not to allow TensorRT to use half-precision kernels. 
+        :param opt_batch_size: The batch size for which TensorRT should optimize the engine. 
+        :param max_batch_size: The largest batch size the engine will accept. 
+        '''
+        assert not getattr(self, 'quantized', False), 'NN.export: Quantized models can not be exported.'
+        assert hasattr(self.scaler, 'scale_'), 'NN.export: The model must be fitted before it is exported.'
+        linear_1, linear_2 = copy.deepcopy(self.model[0]).cpu().float(), copy.deepcopy(self.model[2]).cpu().float()
+        with torch.no_grad(): # (x - mean) / scale @ W.T + b is equivalent to x @ (W / scale).T + (b - (W / scale) @ mean).
+            linear_1.weight /= torch.as_tensor(self.scaler.scale_, dtype=torch.float32)
+            linear_1.bias -= linear_1.weight @ torch.as_tensor(self.scaler.mean_, dtype=torch.float32)
+        model = torch.nn.Sequential(linear_1, torch.nn.ReLU(), linear_2, torch.nn.Softmax(dim=1)).eval()
+
+        input_dim = linear_1.in_features
+        onnx_path, engine_path = path + '.onnx', path + '.engine'
+        torch.onnx.export(model, torch.zeros(1, input_dim), onnx_path, input_names=['embedding'], output_names=['probability'], 
+            dynamic_axes={'embedding':{0:'batch_size'}, 'probability':{0:'batch_size'}})
+        print(f'NN.export: Model written to {onnx_path}.')
+
+        if shutil.which('trtexec') is None:
+            print('NN.export: trtexec not found, so no TensorRT engine was built.')
+            return 
+
+        cmd = f'trtexec --onnx={onnx_path} --saveEngine={engine_path}'
+        cmd += f' --minShapes=embedding:1x{input_dim} --optShapes=embedding:{opt_batch_size}x{input_dim} --maxShapes=embedding:{max_batch_size}x{input_dim}'
+        if fp16:
+            cmd += ' --fp16'
+        subprocess.run(cmd, shell=True, check=True, stdout=subprocess.DEVNULL)
+        print(f'NN.export: TensorRT engine written to {engine_path}.')
+
+    def copy_state_dict(self) -> Dict[str, torch.Tensor]:
+        '''Make a copy of the model's state dict. Cloning the tensors directly is cheaper than a deepcopy.'''
+        return {k:v.detach().clone() for k, v in self.state_dict().items()}
+
+    def fit(self, train_dataset, val_dataset, epochs:int=10, lr:float=1e-8, batch_size:int=16, balance_batches:bool=True, weighted_loss:bool=False, accum_steps:int=1):
         '''Train Classifier model on the data in the DataLoader.
 
         :param train_dataset: The Dataset object containing the training data. 
@@ -149,50 +247,64 @@ class NN(torch.nn.Module):
         :param epochs: The maximum number of epochs to train for. 
         :param lr: The learning rate. 
         :param batch_size: The size of the batches to use for model training.
+        :param accum_steps: The number of batches over which to accumulate gradients before each optimizer step, so the 
+            effective batch size is batch_size * accum_steps. 
         '''
+        assert not getattr(self, 'quantized', False), 'NN.fit: Quantized models can not be trained.'
+        assert accum_steps >= 1, 'NN.fit: The number of gradient accumulation steps must be at least 1.'
         self.train() # Put the model in train mode.
         print(f'Classifier.fit: Training on device {self.device}.')
 
-        self.scaler.fit(train_dataset.embeddings.cpu().numpy()) # Fit the scaler on the training dataset. 
+        self.scaler.fit(train_dataset.embeddings.cpu().float().numpy()) # Fit the scaler on the training dataset. 
         train_dataset = train_dataset.scale(self.scaler) # NOTE: Don't need to scale the validation dataset, as this is done by predict. 
 
         if weighted_loss: # Loss function has equal weights by default.
             self.loss_func.fit(train_dataset) # Set the weights of the loss function.
 
         # NOTE: What does the epsilon parameter do?
-        optimizer = torch.optim.Adam(self.parameters(), lr=lr, eps=1e-8)
-        best_epoch, best_model_weights = 0, copy.deepcopy(self.state_dict())
+        # The fused implementation updates all parameters in a single kernel, but is only available on the GPU.
+        optimizer = torch.optim.Adam(self.parameters(), lr=lr, eps=1e-8, fused=(self.device == 'cuda'))
+        best_epoch, best_model_weights = 0, self.copy_state_dict()
 
         # Want to log the initial training and validation metrics. 
         self.val_accs = [self.accuracy(val_dataset)]
+        best_val_acc = self.val_accs[-1] # Keep track of the running best, rather than re-scanning the history each epoch. 
         self.train_losses = []
 
         dataloader = get_dataloader(train_dataset, batch_size=batch_size, balance_batches=balance_batches)
-        pbar = tqdm(total=epochs * len(dataloader), desc=f'Classifier.fit: Training classifier, epoch 0/{epochs}. Validation accuracy {np.round(self.val_accs[-1], 2)}') 
+        n_batches = len(dataloader)
+        pbar = tqdm(total=epochs * n_batches, desc=f'Classifier.fit: Training classifier, epoch 0/{epochs}. Validation accuracy {np.round(self.val_accs[-1], 2)}') 
 
         for epoch in range(epochs):
-            epoch_train_loss = []
-
-            for batch in dataloader:
-                # Evaluate the model on the batch in the training dataloader. 
-                outputs, targets = self(batch['embedding']), batch['label_one_hot_encoded'] 
-                loss = self.loss_func(outputs, targets)
-                loss.backward() # Takes about 10 percent of total batch time. 
-                epoch_train_loss += [loss.item()]
+            # Accumulate the batch losses on the device, so there is only one device-to-host sync per epoch. 
+            epoch_train_loss = torch.zeros(n_batches, device=self.device)
+
+            for i, batch in enumerate(dataloader):
+                # Evaluate the model on the batch in the training dataloader. Model weights are kept in full precision.
+                with self.autocast():
+                    outputs, targets = self(batch['embedding']), batch['label_one_hot_encoded'] 
+                    loss = self.loss_func(outputs, targets)
+                # Scale the loss so the accumulated gradient is the mean over the effective batch. The last window of the epoch 
+                # may contain fewer than accum_steps batches, so scale by the actual window size. 
+                window_size = min(accum_steps, n_batches - (i // accum_steps) * accum_steps)
+                (loss / window_size).backward() # Takes about 10 percent of total batch time. 
+                epoch_train_loss[i] = loss.detach()
                 
-                optimizer.step()
-                optimizer.zero_grad()
+                # NOTE: If training is ever distributed, the backward passes which don't precede a step should be run under no_sync. 
+                if ((i + 1) % accum_steps == 0) or ((i + 1) == n_batches):
+                    optimizer.step()
+                    optimizer.zero_grad(set_to_none=True) # Avoids writing zeros to every gradient tensor. 
                 
                 pbar.update(1) # Update progress bar after each batch. 
             
             self.val_accs += [self.accuracy(val_dataset)]
-            self.train_losses += [np.mean(epoch_train_loss)]
+            self.train_losses += [epoch_train_loss.mean().item()]
             
             pbar.set_description(f'Classifier.fit: Training classifier, epoch {epoch}/{epochs}. Validation accuracy {np.round(self.val_accs[-1], 2)}')
 
-            if self.val_accs[-1] > max(self.val_accs[:-1]):
-                best_epoch = epoch
-                best_model_weights = copy.deepcopy(self.state_dict())
+            if self.val_accs[-1] > best_val_acc:
+                best_epoch, best_val_acc = epoch, self.val_accs[-1]
+                best_model_weights = self.copy_state_dict()
 
         print(f'Classifier.fit: Loading best model weights, encountered at epoch {best_epoch}.')
         self.load_state_dict(best_model_weights) # Load the best model weights. 
@@ -201,6 +313,7 @@ class NN(torch.nn.Module):
         self.best_epoch = best_epoch
         self.epochs = epochs
         self.batch_size = batch_size
+        self.accum_steps = accum_steps
         self.lr = lr
 
 
@@ -219,19 +332,77 @@ class Classifier():
         self.time_stamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
         self.model.fit(train_dataset, val_dataset, **kwargs)
 
-    def predict(self, dataset) -> pd.DataFrame:
-        return self.model.predict(dataset)
+    def predict(self, dataset, **kwargs) -> pd.DataFrame:
+        return self.model.predict(dataset, **kwargs)
+
+    def quantize(self):
+        self.model.quantize()
+
+    def export(self, path:str, **kwargs):
+        self.model.export(Classifier.split_ext(path)[0], **kwargs)
+
+    # Attributes of the NN and its fitted StandardScaler which are written to the JSON file by Classifier.save. 
+    model_attrs = ['best_epoch', 'epochs', 'batch_size', 'accum_steps', 'lr', 'val_accs', 'train_losses', 'instances_seen_during_training']
+    scaler_attrs = ['mean_', 'var_', 'scale_', 'n_features_in_', 'n_samples_seen_']
+
+    # File extensions written by Classifier.save and Classifier.export. 
+    extensions = ['.pkl', '.json', '.safetensors', '.onnx', '.engine']
+
+    @staticmethod
+    def split_ext(path:str) -> Tuple[str, str]:
+        '''Split the extension from a model path. Only extensions of model files are removed, so that model names containing
+        periods (e.g. model_v0.1) are left intact.'''
+        base, ext = os.path.splitext(path)
+        return (base, ext) if (ext in Classifier.extensions) else (path, '')
 
     @classmethod
     def load(cls, path:str):
-        with open(path, 'rb') as f:
-            # obj = pickle.load(f)
-            obj = Unpickler(f).load()
-        return obj    
+        '''Load a Classifier written by Classifier.save. The path can be given with or without an extension. Models saved
+        by earlier versions were pickled, so fall back to unpickling if there is no JSON file.'''
+        path, ext = Classifier.split_ext(path)
+        if (ext == '.pkl') or (not os.path.exists(path + '.json')):
+            with open(path + '.pkl', 'rb') as f:
+                # obj = pickle.load(f)
+                obj = Unpickler(f).load()
+            # The model may have been trained on a different device, so move it to the available device once on load, rather than
+            # on every forward pass. 
+            obj.model.device, obj.model.loss_func.device = device, device
+            obj.model.to(device)
+            obj.model.compile_model() # Compiled modules are not preserved by pickling. 
+            return obj
+
+        with open(path + '.json', 'r') as f:
+            info = json.load(f)
+        
+        obj = cls(n_classes=info['n_classes'], input_dim=info['input_dim'], hidden_dim=info['hidden_dim'], half_precision=info['half_precision'])
+        obj.time_stamp = info['time_stamp']
+        obj.model.load_state_dict(safetensors.torch.load_file(path + '.safetensors', device=device))
+        for attr in Classifier.model_attrs:
+            if attr in info['model']:
+                setattr(obj.model, attr, info['model'][attr])
+        for attr, value in info['scaler'].items():
+            setattr(obj.model.scaler, attr, np.array(value) if isinstance(value, list) else value)
+        return obj
 
     def save(self, path:str):
-        with open(path, 'wb') as f:
-            pickle.dump(self, f)
+        '''Save the model weights to a safetensors file, and the remaining attributes (including the fitted scaler) to a JSON 
+        file with the same name. Writing the raw tensor bytes is much faster and more compact than serializing the weights element-wise.'''
+        assert not getattr(self.model, 'quantized', False), 'Classifier.save: Quantized models can not be saved.'
+        path, _ = Classifier.split_ext(path)
+
+        state_dict = {k:v.detach().cpu().contiguous() for k, v in self.model.state_dict().items()}
+        safetensors.torch.save_file(state_dict, path + '.safetensors')
+
+        info = dict()
+        info['time_stamp'] = self.time_stamp
+        info['n_classes'] = self.model.model[2].out_features
+        info['input_dim'] = self.model.model[0].in_features
+        info['hidden_dim'] = self.model.model[0].out_features
+        info['half_precision'] = (self.model.dtype == torch.bfloat16)
+        info['model'] = {attr:getattr(self.model, attr) for attr in Classifier.model_attrs if hasattr(self.model, attr)}
+        info['scaler'] = {attr:getattr(self.model.scaler, attr) for attr in Classifier.scaler_attrs if hasattr(self.model.scaler, attr)}
+        with open(path + '.json', 'w') as f:
+            json.dump(info, f, cls=NumpyEncoder)
 
 
 # TODO: Read about how Gaussian HMMs work (where does the Gaussian part come in?)
@@ -3,14 +3,12 @@ import random
 import pandas as pd
 import numpy as np
 import torch
-from torch.utils.data import WeightedRandomSampler
 from typing import List, Dict, NoReturn, Iterator
 import re
 import subprocess
 import time
 import copy
 from torch.nn.functional import one_hot
-from torch.utils.data import DataLoader
 from selenobot.embedders import ESMEmbedder
 from transformers import AutoTokenizer 
 
@@ -52,13 +50,16 @@ class Dataset(torch.utils.data.Dataset):
         '''
         self.n_classes = n_classes
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        # Scaled embeddings are stored in half-precision on the GPU to halve the memory bandwidth. Raw embeddings are kept in
+        # full precision, as features like sequence length can't be represented exactly in bfloat16. Labels are also kept in full precision.
+        self.dtype = torch.bfloat16 if (self.device == 'cuda') else torch.float32
 
         self.labels, self.labels_one_hot_encoded = None, None
         if ('label' in df.columns):
-            self.labels = torch.from_numpy(df['label'].values).type(torch.LongTensor)
+            self.labels = torch.from_numpy(df['label'].values).type(torch.LongTensor).to(self.device)
             self.labels_one_hot_encoded = one_hot(self.labels, num_classes=n_classes).to(torch.float32).to(self.device)
 
-        self.embeddings = torch.from_numpy(df[Dataset.get_feature_cols(df)].values).to(self.device)
+        self.embeddings = self.to_tensor(df[Dataset.get_feature_cols(df)].to_numpy(dtype=np.float32))
         self.n_features = self.embeddings.shape[-1]
         self.metadata = df[[col for col in df.columns if type(col) == str]] 
         self.ids = df.index.values
@@ -66,12 +67,18 @@ class Dataset(torch.utils.data.Dataset):
         self.scaled = False
         self.length = len(df)
         
+    def to_tensor(self, embeddings:np.ndarray, dtype:torch.dtype=torch.float32) -> torch.Tensor:
+        '''Convert an array of embeddings to a tensor of the specified type on the Dataset's device. If the array is already contiguous 
+        float32, it is wrapped without an intermediate host copy before being moved to the device.'''
+        embeddings = torch.from_numpy(np.ascontiguousarray(embeddings, dtype=np.float32))
+        return embeddings.to(self.device, dtype)
+
     def __len__(self) -> int:
         return self.length
 
     def __copy__(self):
         '''Create a copy of the Dataset object.'''
-        embeddings = copy.deepcopy(self.embeddings.cpu().numpy())
+        embeddings = copy.deepcopy(self.embeddings.cpu().float().numpy())
         metadata = self.metadata.copy(deep=True)
         # df = metadata.merge(pd.DataFrame(embeddings, index=self.ids), left_index=True, right_index=True, validate='one_to_one')
         df = pd.concat([metadata, pd.DataFrame(embeddings, index=self.ids)], ignore_index=False, axis=1)
@@ -85,9 +92,9 @@ class Dataset(torch.utils.data.Dataset):
         # subsequent applications of a scaler would have no effect. 
         assert not self.scaled, 'Dataset.scale: The dataset has already been scaled.'
         dataset = copy.copy(self)
-        embeddings = dataset.embeddings.cpu().numpy()
+        embeddings = dataset.embeddings.cpu().float().numpy()
         embeddings = scaler.transform(embeddings)
-        embeddings = torch.FloatTensor(embeddings).to(dataset.device)
+        embeddings = dataset.to_tensor(embeddings, dtype=dataset.dtype)
         dataset.embeddings = embeddings
         dataset.scaled = True
         return dataset
@@ -104,28 +111,21 @@ class Dataset(torch.utils.data.Dataset):
     def shape(self):
         return self.embeddings.shape
 
-    def sampler(self, p:float=0.99) -> torch.utils.data.WeightedRandomSampler:
-        '''Uses labels to generate a WeightedRandomSampler for balancing DataLoader batches.
-        
-        :param p: The lower bound for the probability that any training instance will be included in the
-            final dataset. 
-        '''
-        labels = self.labels.numpy()
-
-        N = len(labels) # Total number of things in the dataset. 
-        n = [(labels == i).sum() for i in range(self.n_classes)] # The number of elements in each class. 
-        # Compute the minimum number of samples such that each training instance will probably be included at least once.
-        s = int(max([np.log(1 - p) / np.log(1 - 1 / n_i) for n_i in n])) * self.n_classes
-        w = [(1 / (n_i)) for n_i in n] # Proportional to the inverse frequency of each class. 
-        
-        print(f'Dataset.sampler: {s} samples required for dataset coverage.')
-        return torch.utils.data.WeightedRandomSampler([w[i] for i in labels], s, replacement=True)
+    def balanced_num_samples(self) -> int:
+        '''Uses labels to compute the number of samples per epoch when batches are balanced (see get_batch_idxs). Because each class's
+        indices are tiled up to an equal share of the samples, every training instance is included as long as each class gets as 
+        many samples as the largest class has instances.'''
+        n = torch.bincount(self.labels, minlength=self.n_classes) # The number of elements in each class. 
+        s = int(n.max()) * self.n_classes
+        print(f'Dataset.balanced_num_samples: {s} samples required for each instance to be included at least once in a balanced epoch.')
+        return s
 
 
-    def __getitem__(self, idx:int) -> Dict:
-        '''Returns an item from the Dataset. Also returns the underlying index for testing purposes.'''
+    def __getitem__(self, idx) -> Dict[str, torch.Tensor]:
+        '''Returns an item from the Dataset. The index can also be a tensor of indices, in which case an entire batch is gathered 
+        from the stored tensors at once. Only tensors are returned; IDs can be retrieved using dataset.ids[idx].'''
         # embeddings = self.embeddings[:, self.features] # Make sure to filter embeddings by selected features. 
-        item = {'embedding':self.embeddings[idx], 'id':self.ids[idx], 'idx':idx}
+        item = {'embedding':self.embeddings[idx]}
         if self.labels is not None: # Include the label if the Dataset is labeled.
             item['label'] = self.labels[idx]
             item['label_one_hot_encoded'] = self.labels_one_hot_encoded[idx]
@@ -134,7 +134,7 @@ class Dataset(torch.utils.data.Dataset):
     def to_df(self, add_metadata:bool=True) -> pd.DataFrame:
         '''Convert the Dataset back into a DataFrame in the same format as the DataFrame that was used
         to intitialize it.''' 
-        df = pd.DataFrame(self.embeddings.cpu().numpy(), index=self.ids)
+        df = pd.DataFrame(self.embeddings.cpu().float().numpy(), index=self.ids)
         if add_metadata:
             df = pd.concat([df, self.metadata], axis=1, ignore_index=False)
         return df
@@ -153,13 +153,70 @@ class Dataset(torch.utils.data.Dataset):
 
 
 
-def get_dataloader(dataset:Dataset, batch_size:int=16, balance_batches:bool=False) -> DataLoader:
-    '''Produce a DataLoader object for each batching of the input Dataset.'''
-    if balance_batches:
-        return DataLoader(dataset, sampler=dataset.sampler(), batch_size=batch_size)
-        # return torch.utils.data.DataLoader(dataset, batch_sampler= BalancedBatchSampler(dataset, batch_size=batch_size))
+def get_num_batches(dataset:Dataset, batch_size:int=16, n_samples:int=None) -> int:
+    '''Compute the number of batches drawn by get_batch_idxs, i.e. the number of samples divided by the batch size, rounded up.'''
+    n = len(dataset) if (n_samples is None) else n_samples
+    return -(-n // batch_size) # Ceiling division. 
+
+
+def get_batch_idxs(dataset:Dataset, batch_size:int=16, n_samples:int=None) -> torch.Tensor:
+    '''Draw the indices for each batch of the input Dataset directly on the device where the Dataset is stored. Batches can 
+    then be gathered from the stored tensors with index_select, avoiding the per-item __getitem__ calls, collation, and 
+    host-to-device copies of a DataLoader.
+    
+    :param dataset: The Dataset to batch. 
+    :param batch_size: The number of instances in each batch. 
+    :param n_samples: If specified, this many samples are drawn and the batches are balanced so that each class contributes an 
+        equal share of the samples (see Dataset.balanced_num_samples). Otherwise, the Dataset is shuffled. 
+    :return: A tensor of size (n_batches, batch_size), where each row contains the indices of a batch. If the number of 
+        samples is not a multiple of the batch size, the last batch is topped up with additional randomly-selected indices.
+    '''
+    n = len(dataset) if (n_samples is None) else n_samples
+    n_batches = get_num_batches(dataset, batch_size=batch_size, n_samples=n_samples)
+
+    if n_samples is not None:
+        # Rather than sampling with replacement, shuffle the indices of each class and tile them up to the class's share of the 
+        # samples. This way, every instance in a class is included the same number of times (plus or minus one). 
+        n_per_class = -(-(n_batches * batch_size) // dataset.n_classes)
+        idxs = []
+        for i in range(dataset.n_classes):
+            class_idxs = torch.nonzero(dataset.labels == i).ravel()
+            class_idxs = class_idxs[torch.randperm(len(class_idxs), device=dataset.device)]
+            idxs.append(class_idxs.repeat(-(-n_per_class // len(class_idxs)))[:n_per_class])
+        idxs = torch.cat(idxs)
+        idxs = idxs[torch.randperm(len(idxs), device=dataset.device)][:n_batches * batch_size]
     else:
-        return DataLoader(dataset, batch_size=batch_size, shuffle=True)
+        idxs = torch.randperm(n, device=dataset.device)
+        # Draw the padding independently, so that it works even if the Dataset is smaller than the batch size. 
+        idxs = torch.cat([idxs, torch.randint(n, (n_batches * batch_size - n,), device=dataset.device)])
+    # Reshaping is a view, so this avoids allocating a separate tensor for each batch. 
+    return idxs.view(n_batches, batch_size)
+
+
+class BatchIterator():
+    '''An iterable over batches of a Dataset. Because the Dataset tensors are already stored on the device, batches are gathered
+    directly from them, which avoids the worker processes and per-item collation of a DataLoader.'''
+
+    def __init__(self, dataset:Dataset, batch_size:int=16, n_samples:int=None):
+        
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.n_samples = n_samples 
+        self.n_batches = get_num_batches(dataset, batch_size=batch_size, n_samples=n_samples)
+
+    def __len__(self) -> int:
+        return self.n_batches
+
+    def __iter__(self) -> Iterator[Dict[str, torch.Tensor]]:
+        # Batch indices are re-drawn on each pass, in the same way a DataLoader is re-shuffled each epoch. 
+        for idxs in get_batch_idxs(self.dataset, batch_size=self.batch_size, n_samples=self.n_samples):
+            yield self.dataset[idxs]
+
+
+def get_dataloader(dataset:Dataset, batch_size:int=16, balance_batches:bool=False) -> BatchIterator:
+    '''Produce a BatchIterator for batching the input Dataset.'''
+    n_samples = dataset.balanced_num_samples() if balance_batches else None
+    return BatchIterator(dataset, batch_size=batch_size, n_samples=n_samples)
 
 
 
@@ -0,0 +1,88 @@
+'''Triton kernels for running inference with the classification head on a GPU.'''
+
+import torch
+import triton
+import triton.language as tl
+
+
+@triton.jit
+def mlp_softmax_kernel(x_ptr, w1_ptr, b1_ptr, w2_ptr, b2_ptr, y_ptr, B, K, H, C,
+    stride_xb, stride_xk, stride_w1h, stride_w1k, stride_w2c, stride_w2h, stride_yb, stride_yc,
+    BLOCK_B:tl.constexpr, BLOCK_K:tl.constexpr, BLOCK_H:tl.constexpr, BLOCK_C:tl.constexpr):
+    '''Computes softmax(relu(x @ W1.T + b1) @ W2.T + b2) for a block of BLOCK_B rows of the input. The hidden layer
+    is computed BLOCK_H units at a time and immediately reduced into the output logits, so it never leaves registers.'''
+    pid = tl.program_id(0)
+    offs_b = pid * BLOCK_B + tl.arange(0, BLOCK_B)
+    offs_c = tl.arange(0, BLOCK_C)
+    mask_b, mask_c = offs_b < B, offs_c < C
+
+    acc = tl.zeros((BLOCK_B, BLOCK_C), dtype=tl.float32)
+    for h_start in range(0, H, BLOCK_H):
+        offs_h = h_start + tl.arange(0, BLOCK_H)
+        mask_h = offs_h < H
+
+        # Accumulate a (BLOCK_B, BLOCK_H) tile of the hidden layer over the input dimension.
+        h = tl.zeros((BLOCK_B, BLOCK_H), dtype=tl.float32)
+        for k_start in range(0, K, BLOCK_K):
+            offs_k = k_start + tl.arange(0, BLOCK_K)
+            mask_k = offs_k < K
+            x = tl.load(x_ptr + offs_b[:, None] * stride_xb + offs_k[None, :] * stride_xk, mask=mask_b[:, None] & mask_k[None, :], other=0.0)
+            # Load the tile of W1 transposed, so it has shape (BLOCK_K, BLOCK_H).
+            w1 = tl.load(w1_ptr + offs_h[None, :] * stride_w1h + offs_k[:, None] * stride_w1k, mask=mask_h[None, :] & mask_k[:, None], other=0.0)
+            h += tl.dot(x.to(w1.dtype), w1)
+
+        b1 = tl.load(b1_ptr + offs_h, mask=mask_h, other=0.0)
+        h = tl.maximum(h + b1[None, :].to(tl.float32), 0.0) # Apply the ReLU activation.
+
+        # Load the tile of W2 transposed, so it has shape (BLOCK_H, BLOCK_C).
+        w2 = tl.load(w2_ptr + offs_c[None, :] * stride_w2c + offs_h[:, None] * stride_w2h, mask=mask_c[None, :] & mask_h[:, None], other=0.0)
+        acc += tl.dot(h.to(w2.dtype), w2)
+
+    b2 = tl.load(b2_ptr + offs_c, mask=mask_c, other=0.0)
+    logits = acc + b2[None, :].to(tl.float32)
+    # The class dimension is padded up to BLOCK_C, so mask out the padding before applying the softmax.
+    logits = tl.where(mask_c[None, :], logits, float('-inf'))
+    logits = logits - tl.max(logits, axis=1)[:, None]
+    y = tl.exp(logits)
+    y = y / tl.sum(y, axis=1)[:, None]
+    tl.store(y_ptr + offs_b[:, None] * stride_yb + offs_c[None, :] * stride_yc, y, mask=mask_b[:, None] & mask_c[None, :])
+
+
+def mlp_softmax(x:torch.Tensor, w1:torch.Tensor, b1:torch.Tensor, w2:torch.Tensor, b2:torch.Tensor, block_b:int=64, block_k:int=64, block_h:int=128) -> torch.Tensor:
+    '''Run the fused Linear-ReLU-Linear-Softmax kernel.
+
+    :param x: A tensor of size (batch_size, input_dim).
+    :param w1: The weights of the first Linear layer, of size (hidden_dim, input_dim).
+    :param b1: The bias of the first Linear layer, of size (hidden_dim,).
+    :param w2: The weights of the second Linear layer, of size (output_dim, hidden_dim).
+    :param b2: The bias of the second Linear layer, of size (output_dim,).
+    :return: A float32 tensor of size (batch_size, output_dim) containing the class probabilities.
+    '''
+    (B, K), H, C = x.shape, w1.shape[0], w2.shape[0]
+    y = torch.empty((B, C), device=x.device, dtype=torch.float32)
+    block_c = max(16, triton.next_power_of_2(C)) # tl.dot requires each dimension to be at least 16.
+
+    grid = (triton.cdiv(B, block_b),)
+    mlp_softmax_kernel[grid](x, w1, b1, w2, b2, y, B, K, H, C,
+        x.stride(0), x.stride(1), w1.stride(0), w1.stride(1), w2.stride(0), w2.stride(1), y.stride(0), y.stride(1),
+        BLOCK_B=block_b, BLOCK_K=block_k, BLOCK_H=block_h, BLOCK_C=block_c)
+    return y
+
+
+if __name__ == '__main__':
+    # Check the fused kernel against the eager forward pass used by NN.predict. Run with python -m selenobot.kernels on a GPU.
+    assert torch.cuda.is_available(), 'kernels: A GPU is required to run the fused kernel.'
+    torch.manual_seed(42)
+
+    # Use a batch size which is not a multiple of the block size, and class counts which require padding.
+    for input_dtype in [torch.float32, torch.bfloat16]:
+        for output_dim in [2, 3]:
+            model = torch.nn.Sequential(torch.nn.Linear(1024, 512), torch.nn.ReLU(), torch.nn.Linear(512, output_dim)).cuda()
+            x = torch.randn(1000, 1024, device='cuda').to(input_dtype)
+
+            with torch.inference_mode():
+                y_eager = torch.nn.functional.softmax(model(x.float()), 1)
+                y_fused = mlp_softmax(x, model[0].weight, model[0].bias, model[2].weight, model[2].bias)
+            # tl.dot uses TF32 for float32 inputs, so allow for some rounding error.
+            torch.testing.assert_close(y_fused, y_eager, atol=1e-2, rtol=0)
+            print(f'kernels: Fused kernel matches eager forward pass for input_dtype={input_dtype}, output_dim={output_dim}.')